@@ -1,43 +1,30 @@
 import os
+import asyncio
 import uuid
 import json
 import re
-from typing import Dict, List, Optional
+import time
+import httpx
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Set, Tuple
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from memory import SimpleMemory, MAX_SESSIONS, MAX_TURNS
 from order_tool import ORDER_TOOLS
+from rate_limit import throttle
 
 # Load environment variables
 load_dotenv()
 
-class SimpleMemory:
-    """Simple in-memory storage for chat history."""
-    
-    def __init__(self):
-        self._sessions: Dict[str, List] = {}
-    
-    def load_memory_variables(self, inputs: Dict[str, any]) -> Dict[str, any]:
-        session_id = inputs.get("session_id", "default")
-        messages = self._sessions.get(session_id, [])
-        return {"messages": messages}
-    
-    def save_context(self, inputs: Dict[str, any], outputs: Dict[str, str]) -> None:
-        session_id = inputs.get("session_id", "default")
-        if session_id not in self._sessions:
-            self._sessions[session_id] = []
-        
-        # Add user message
-        if "message" in inputs:
-            self._sessions[session_id].append(HumanMessage(content=inputs["message"]))
-        
-        # Add AI response
-        if "reply" in outputs:
-            self._sessions[session_id].append(AIMessage(content=outputs["reply"]))
-    
-    def clear(self) -> None:
-        self._sessions.clear()
+SYSTEM_PROMPT = "You are a helpful assistant for EchoEats restaurant. Be friendly and engaging in your responses. You have access to order search tools to help customers find their previous orders. Use these tools when customers ask about their order history."
+
+# Maximum number of cached replies to repeated opening messages
+CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", 512))
+# Seconds a cached reply stays valid
+CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 300))
 
 class LLMService:
     def __init__(self):
@@ -49,6 +36,24 @@ class LLMService:
         self.model = None
         self.model_with_tools = None
         self.memory = SimpleMemory()
+        self._system = SystemMessage(content=SYSTEM_PROMPT)
+        self._tool_by_name = {tool.name: tool for tool in ORDER_TOOLS}
+        # Cache key -> (expiry time, reply) for opening messages; replies that used tools are never cached
+        self._resp_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # Holders plus waiters per session lock; a lock is dropped when this reaches zero
+        self._lock_users: Dict[str, int] = {}
+        # Background work (e.g. summaries) is referenced here until it finishes
+        self._background: Set[asyncio.Task] = set()
+        self._summarizing: Set[str] = set()
+        # Turn count at which a session whose summary failed is retried
+        self._summary_due: Dict[str, int] = {}
+        # Shared keep-alive pool so concurrent calls reuse upstream connections
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            http2=True,
+            timeout=60
+        )
         
         if self.api_key and self.api_base and self.model_name:
             try:
@@ -56,7 +61,8 @@ class LLMService:
                     model=self.model_name,
                     base_url=self.api_base,
                     api_key=self.api_key,
-                    temperature=0.7
+                    temperature=0.7,
+                    http_async_client=self._http
                 )
                 # Bind tools to the model
                 self.model_with_tools = self.model.bind_tools(ORDER_TOOLS)
@@ -80,92 +86,251 @@ class LLMService:
         if not session_id:
             session_id = str(uuid.uuid4())
         
-        try:
-            # Get existing messages for this session
-            memory_vars = self.memory.load_memory_variables({"session_id": session_id})
-            existing_messages = memory_vars["messages"]
-            
-            # Create conversation messages
-            messages = [
-                SystemMessage(content="You are a helpful assistant for EchoEats restaurant. Be friendly and engaging in your responses. You have access to order search tools to help customers find their previous orders. Use these tools when customers ask about their order history.")
-            ]
-            
-            # Add conversation history
-            messages.extend(existing_messages)
-            
-            # Add current user message
-            messages.append(HumanMessage(content=message))
-            
-            # Get response from model with tools
-            response = self.model_with_tools.invoke(messages)
-            
-            # Check if the model wants to call tools
-            if hasattr(response, 'tool_calls') and response.tool_calls:
-                # Execute tool calls
-                tool_results = []
-                for tool_call in response.tool_calls:
-                    tool_name = tool_call['name']
-                    tool_args = tool_call['args']
+        # Serialize turns per session so concurrent requests cannot interleave history
+        async with self._lock(session_id):
+            try:
+                messages = await self._build_messages(message, session_id)
+                
+                # Serve repeated opening messages from the response cache
+                cache_key = self._cache_key(messages)
+                final_content = self._cache_get(cache_key) if cache_key else None
+                if final_content is None:
+                    response, used_tools = await self._generate(messages)
+                    final_content = response.content
+                    if cache_key and not used_tools:
+                        # Tool results (orders, dates) can change, so only plain replies are cached
+                        self._cache_put(cache_key, final_content)
+                
+                await self._remember(message, final_content, session_id)
+                
+                return {
+                    "reply": final_content,
+                    "session_id": session_id,
+                    "message_count": await self.memory.message_count(session_id)
+                }
+                
+            except Exception as e:
+                print(f"Error calling LLM: {e}")
+                return {
+                    "reply": f"echo: {message}",
+                    "session_id": session_id,
+                    "message_count": 0
+                }
+    
+    async def chat_stream(self, message: str, session_id: str) -> AsyncIterator[str]:
+        """Stream the LLM reply for a message as text chunks, saving it once complete."""
+        if not self.model_with_tools:
+            yield f"echo: {message}"
+            return
+        
+        async with self._lock(session_id):
+            parts = []
+            try:
+                messages = await self._build_messages(message, session_id)
+                cache_key = self._cache_key(messages)
+                cached = self._cache_get(cache_key) if cache_key else None
+                if cached is not None:
+                    parts.append(cached)
+                    yield cached
+                else:
+                    await throttle(messages)
+                    response = None
+                    async for chunk in self.model_with_tools.astream(messages):
+                        response = chunk if response is None else response + chunk
+                        if chunk.content:
+                            parts.append(chunk.content)
+                            yield chunk.content
                     
-                    # Find and execute the tool
-                    for tool in ORDER_TOOLS:
-                        if tool.name == tool_name:
-                            try:
-                                result = tool.invoke(tool_args)
-                                tool_results.append(f"Tool {tool_name}: {result}")
-                            except Exception as e:
-                                tool_results.append(f"Tool {tool_name} error: {str(e)}")
-                            break
+                    # Run requested tools, then stream the final answer
+                    if response is not None and response.tool_calls:
+                        messages.append(await self._run_tools(response.tool_calls))
+                        await throttle(messages)
+                        async for chunk in self.model_with_tools.astream(messages):
+                            if chunk.content:
+                                parts.append(chunk.content)
+                                yield chunk.content
+                    elif cache_key:
+                        # Tool results (orders, dates) can change, so only plain replies are cached
+                        self._cache_put(cache_key, "".join(parts))
                 
-                # Create a new message with tool results
-                tool_message = AIMessage(content=f"Tool results: {'; '.join(tool_results)}")
-                messages.append(tool_message)
+                await self._remember(message, "".join(parts), session_id)
                 
-                # Get final response
-                final_response = self.model_with_tools.invoke(messages)
-                final_content = final_response.content
-            else:
-                final_content = response.content
-            
-            # Save to memory
-            self.memory.save_context(
-                {"message": message, "session_id": session_id},
-                {"reply": final_content}
-            )
-            
-            # Get updated message count
-            updated_memory = self.memory.load_memory_variables({"session_id": session_id})
-            message_count = len(updated_memory["messages"])
-            
-            return {
-                "reply": final_content,
-                "session_id": session_id,
-                "message_count": message_count
-            }
+            except Exception as e:
+                print(f"Error streaming from LLM: {e}")
+                if not parts:
+                    yield f"echo: {message}"
+    
+    @asynccontextmanager
+    async def _lock(self, session_id: str) -> AsyncIterator[None]:
+        """Hold the lock serializing turns for a session, dropping it once nobody holds or awaits it."""
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        self._lock_users[session_id] = self._lock_users.get(session_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[session_id] -= 1
+            if not self._lock_users[session_id]:
+                del self._lock_users[session_id], self._locks[session_id]
+    
+    async def _build_messages(self, message: str, session_id: str) -> List:
+        """Assemble the system prompt, recalled turns, cached session context and new user message."""
+        messages = [self._system]
+        
+        # Add archived turns relevant to this message, if any have left the window
+        if self.memory.can_recall(session_id):
+            recalled = await asyncio.to_thread(self.memory.recall, session_id, message)
+            if recalled:
+                messages.append(SystemMessage(content="Relevant earlier conversation:\n" + "\n\n".join(recalled)))
+        
+        # Add cached conversation context (summary + recent turns)
+        messages.extend(await self.memory.get_prefix(session_id))
+        
+        # Add current user message
+        messages.append(HumanMessage(content=message))
+        return messages
+    
+    async def _remember(self, message: str, reply: str, session_id: str) -> None:
+        """Save a completed turn to memory and keep the context window bounded."""
+        await self.memory.save_context(
+            {"message": message, "session_id": session_id},
+            {"reply": reply}
+        )
+        
+        # Fold older turns into a summary once the window is exceeded, without delaying the reply
+        due = self._summary_due.get(session_id, MAX_TURNS)
+        if self.memory.turn_count(session_id) > due and session_id not in self._summarizing:
+            self._summarizing.add(session_id)
+            self._spawn(self._summarize(session_id))
+    
+    def _spawn(self, coro: Awaitable) -> asyncio.Task:
+        """Run a coroutine in the background, keeping a reference until it finishes."""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+    
+    def _cache_get(self, cache_key: str) -> Optional[str]:
+        """Get an unexpired reply from the response cache."""
+        entry = self._resp_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._resp_cache[cache_key]
+            return None
+        self._resp_cache.move_to_end(cache_key)
+        return entry[1]
+    
+    def _cache_put(self, cache_key: str, reply: str) -> None:
+        """Store a reply in the response cache, evicting the least recently used."""
+        self._resp_cache[cache_key] = (time.monotonic() + CACHE_TTL, reply)
+        if len(self._resp_cache) > CACHE_MAX:
+            self._resp_cache.popitem(last=False)
+    
+    async def _generate(self, messages: List) -> Tuple[AIMessage, bool]:
+        """Run the model (and any requested tool calls); return the final response and whether tools ran."""
+        # Get response from model with tools
+        response = await self._invoke(messages)
+        
+        # Check if the model wants to call tools
+        if hasattr(response, 'tool_calls') and response.tool_calls:
+            messages.append(await self._run_tools(response.tool_calls))
             
+            # Get final response
+            return await self._invoke(messages), True
+        
+        return response, False
+    
+    async def _run_tools(self, tool_calls: List[Dict]) -> AIMessage:
+        """Execute independent tool calls concurrently and collect their results."""
+        tool_calls = [call for call in tool_calls if call['name'] in self._tool_by_name]
+        tool_results = await asyncio.gather(*[self._run_tool(call) for call in tool_calls])
+        
+        # Create a new message with tool results
+        return AIMessage(content=f"Tool results: {'; '.join(tool_results)}")
+    
+    async def _run_tool(self, tool_call: Dict) -> str:
+        """Execute a single tool call and format its result."""
+        tool_name = tool_call['name']
+        try:
+            result = await self._tool_by_name[tool_name].ainvoke(tool_call['args'])
+            return f"Tool {tool_name}: {result}"
         except Exception as e:
-            print(f"Error calling LLM: {e}")
-            return {
-                "reply": f"echo: {message}",
-                "session_id": session_id,
-                "message_count": 0
-            }
+            return f"Tool {tool_name} error: {str(e)}"
+    
+    async def _invoke(self, messages: List):
+        """Send a prompt to the model once it fits the rate limits."""
+        await throttle(messages)
+        return await self.model_with_tools.ainvoke(messages)
+    
+    @staticmethod
+    def _cache_key(messages: List) -> Optional[str]:
+        """Key an opening message (system prompt + user message only) for the response cache.
+        
+        Later turns carry the session's growing history, so their prompts never repeat
+        and are not cached.
+        """
+        if len(messages) != 2:
+            return None
+        return blake2b(messages[-1].content.encode(), digest_size=16).hexdigest()
     
+    async def _summarize(self, session_id: str) -> None:
+        """Summarize turns that fell out of the context window once the session is idle."""
+        try:
+            # Runs after the reply; the session lock keeps the next turn from reading a half-compacted context
+            async with self._lock(session_id):
+                keep_turns = MAX_TURNS // 2
+                older = (await self.memory.get_prefix(session_id))[:-keep_turns * 2]
+                labels = {"human": "Human: ", "ai": "Assistant: "}
+                transcript = [labels.get(msg.type, "") + msg.content for msg in older]
+                
+                prompt = [HumanMessage(content=(
+                    "Summarize the following conversation between a customer and the EchoEats assistant. "
+                    "Keep any order details, preferences and open requests.\n\n" + "\n".join(transcript)
+                ))]
+                
+                try:
+                    await throttle(prompt)
+                    summary = await self.model.ainvoke(prompt)
+                except Exception as e:
+                    # Retry after another keep_turns turns rather than on every turn
+                    print(f"Error summarizing chat history: {e}")
+                    if len(self._summary_due) >= MAX_SESSIONS:
+                        self._summary_due.clear()
+                    self._summary_due[session_id] = self.memory.turn_count(session_id) + keep_turns
+                    return
+                self._summary_due.pop(session_id, None)
+                
+                try:
+                    # Keep the verbatim turns searchable now that they are folded into the summary
+                    await asyncio.to_thread(self.memory.archive, session_id, older)
+                except Exception as e:
+                    print(f"Error archiving chat history: {e}")
+                await self.memory.compact(session_id, summary.content, keep_turns)
+        finally:
+            self._summarizing.discard(session_id)
+
+    async def async_init(self) -> None:
+        """Warm the upstream connection before serving."""
+        if not self.model:
+            return
+        
+        try:
+            # One tiny call establishes the TLS session in the shared pool
+            await self.model.bind(max_tokens=1).ainvoke("ping")
+        except Exception as e:
+            print(f"Model warm-up failed: {e}")
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP connection pool."""
+        await self._http.aclose()
 
-    def get_chat_history(self, session_id: str) -> List[Dict]:
+    async def get_chat_history(self, session_id: str) -> List[Dict]:
         """Get chat history for a specific session."""
         try:
-            memory_vars = self.memory.load_memory_variables({"session_id": session_id})
-            messages = memory_vars["messages"]
-            history = []
-            
-            for msg in messages:
-                if isinstance(msg, HumanMessage):
-                    history.append({"role": "user", "content": msg.content})
-                elif isinstance(msg, AIMessage):
-                    history.append({"role": "assistant", "content": msg.content})
-            
-            return history
+            return await self.memory.get_history(session_id)
             
         except Exception as e:
             print(f"Error getting chat history: {e}")
@@ -1,15 +1,19 @@
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
+import json
+import uuid
+import asyncio
 from llm import llm_service
-from voice import voice_service
+from voice import voice_service, split_sentences
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="EchoEats Chat API")
+app = FastAPI(title="EchoEats Chat API", default_response_class=ORJSONResponse)
 
 # Configure CORS
 allow_origin = os.getenv("ALLOW_ORIGIN", "http://localhost:3000")
@@ -19,8 +23,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
 
+@app.on_event("startup")
+async def startup():
+    """Warm up upstream connections before accepting requests."""
+    await llm_service.async_init()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Release shared upstream connections."""
+    await llm_service.aclose()
+    voice_service.close()
+
 class ChatRequest(BaseModel):
     message: str
     sessionId: str = None
@@ -47,6 +63,9 @@ class VoiceChatResponse(BaseModel):
     session_id: str
     message_count: int
 
+class TextToSpeechRequest(BaseModel):
+    text: str
+
 class SpeechToTextResponse(BaseModel):
     text: str
     success: bool
@@ -59,18 +78,28 @@ async def health_check():
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Chat endpoint that processes messages with session management."""
-    result = await llm_service.chat_once(request.message, request.sessionId)
-    return ChatResponse(
-        reply=result["reply"],
-        session_id=result["session_id"],
-        message_count=result["message_count"]
-    )
+    return await llm_service.chat_once(request.message, request.sessionId)
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat endpoint that streams the reply as server-sent events."""
+    session_id = request.sessionId or str(uuid.uuid4())
+    
+    async def events():
+        async for chunk in llm_service.chat_stream(request.message, session_id):
+            yield f"data: {json.dumps({'t': chunk})}\n\n"
+        
+        # Final event carries the session info returned by /chat
+        message_count = await llm_service.memory.message_count(session_id)
+        yield f"data: {json.dumps({'session_id': session_id, 'message_count': message_count})}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 @app.get("/chat/history/{session_id}", response_model=ChatHistoryResponse)
 async def get_chat_history(session_id: str):
     """Get chat history for a specific session."""
-    history = llm_service.get_chat_history(session_id)
-    return ChatHistoryResponse(session_id=session_id, history=history)
+    history = await llm_service.get_chat_history(session_id)
+    return {"session_id": session_id, "history": history}
 
 @app.post("/voice/chat", response_model=VoiceChatResponse)
 async def voice_chat(request: VoiceChatRequest):
@@ -81,12 +110,51 @@ async def voice_chat(request: VoiceChatRequest):
     # Convert text to speech
     audio_base64 = await voice_service.text_to_speech(result["reply"])
     
-    return VoiceChatResponse(
-        reply=result["reply"],
-        audio=audio_base64 or "",
-        session_id=result["session_id"],
-        message_count=result["message_count"]
-    )
+    return {**result, "audio": audio_base64 or ""}
+
+@app.post("/voice/stream")
+async def voice_stream(request: VoiceChatRequest):
+    """Voice chat endpoint that streams MP3 audio sentence by sentence as the reply is generated."""
+    session_id = request.sessionId or str(uuid.uuid4())
+    
+    async def audio():
+        # Synthesize each sentence as soon as it is complete while the LLM keeps streaming,
+        # and send each sentence's audio, in order, as soon as it is ready
+        # (VoiceService bounds how many sentences are synthesized concurrently)
+        synthesis: asyncio.Queue = asyncio.Queue()
+        
+        async def produce():
+            try:
+                async for sentence in split_sentences(llm_service.chat_stream(request.message, session_id)):
+                    synthesis.put_nowait(asyncio.create_task(voice_service.synthesize(sentence)))
+            finally:
+                synthesis.put_nowait(None)
+        
+        producer = asyncio.create_task(produce())
+        task = None
+        try:
+            while (task := await synthesis.get()) is not None:
+                chunk = await task
+                if chunk:
+                    yield chunk
+        finally:
+            # Stop generating and synthesizing for a client that has gone away
+            producer.cancel()
+            if task is not None:
+                task.cancel()
+            while not synthesis.empty():
+                pending = synthesis.get_nowait()
+                if pending is not None:
+                    pending.cancel()
+    
+    return StreamingResponse(audio(), media_type="audio/mpeg", headers={"X-Session-Id": session_id})
+
+@app.post("/voice/tts")
+async def text_to_speech(request: TextToSpeechRequest):
+    """Synthesize text and stream raw MP3 audio as it is generated."""
+    if not voice_service.client:
+        return Response(status_code=503)
+    return StreamingResponse(voice_service.text_to_speech_stream(request.text), media_type="audio/mpeg")
 
 @app.post("/voice/stt", response_model=SpeechToTextResponse)
 async def speech_to_text(audio_file: UploadFile = File(...)):
@@ -109,4 +177,13 @@ async def speech_to_text(audio_file: UploadFile = File(...)):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # One worker by default: each process caches session context, locks and summaries
+    # itself, so a session served by several workers would lose turns
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WORKERS", 1)),
+        loop="uvloop",
+        http="httptools"
+    )
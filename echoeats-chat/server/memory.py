@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import sqlite3
+from collections import deque, OrderedDict
+from typing import Dict, List, Optional, Protocol, Tuple
+from dotenv import load_dotenv
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+
+load_dotenv()
+
+# Number of verbatim turns kept in the model context before older ones are summarized
+MAX_TURNS = int(os.getenv("MAX_TURNS", 20))
+
+# Bounds on stored chat history: messages per session and number of sessions
+MAX_HISTORY = int(os.getenv("MAX_HISTORY", 200))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", 10_000))
+
+# Chat history storage: "memory" (process-local), "sqlite" (persistent) or "redis" (persistent, shared store)
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "chat.db")
+
+# Embedding recall over turns that left the context window (requires sentence-transformers)
+MEMORY_RETRIEVAL = os.getenv("MEMORY_RETRIEVAL", "false").lower() == "true"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+RECALL_K = int(os.getenv("RECALL_K", 5))
+SESSION_TTL = int(os.getenv("SESSION_TTL", 7 * 24 * 3600))
+
+# Role tags stored alongside message content
+USER, ASSISTANT = 0, 1
+ROLE_NAMES = ("user", "assistant")
+
+def to_message(role: int, content: str) -> BaseMessage:
+    """Materialize a stored (role, content) pair as a LangChain message."""
+    return HumanMessage(content=content) if role == USER else AIMessage(content=content)
+
+class MemoryBackend(Protocol):
+    """Storage for per-session chat transcripts."""
+    
+    async def append(self, session_id: str, role: int, content: str) -> None: ...
+    
+    async def messages(self, session_id: str, last: Optional[int] = None) -> List[BaseMessage]: ...
+    
+    async def history(self, session_id: str) -> List[Tuple[int, str]]: ...
+    
+    async def count(self, session_id: str) -> int: ...
+    
+    async def clear(self) -> None: ...
+
+class InMemoryBackend:
+    """Process-local transcripts, bounded per session and LRU-evicted across sessions.
+    
+    Each session is stored column-wise as message contents plus a bytearray of
+    role tags; message objects are only built when a caller asks for them.
+    """
+    
+    def __init__(self, max_history: int = MAX_HISTORY, max_sessions: int = MAX_SESSIONS):
+        self.max_history = max_history
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Tuple[deque, bytearray]]" = OrderedDict()
+    
+    async def append(self, session_id: str, role: int, content: str) -> None:
+        if session_id not in self._sessions:
+            self._sessions[session_id] = (deque(maxlen=self.max_history), bytearray())
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        
+        contents, roles = self._sessions[session_id]
+        if len(roles) == self.max_history:
+            del roles[0]
+        contents.append(content)
+        roles.append(role)
+    
+    async def messages(self, session_id: str, last: Optional[int] = None) -> List[BaseMessage]:
+        if session_id not in self._sessions:
+            return []
+        self._sessions.move_to_end(session_id)
+        
+        contents, roles = self._sessions[session_id]
+        start = max(len(roles) - last, 0) if last is not None else 0
+        return [to_message(roles[i], contents[i]) for i in range(start, len(roles))]
+    
+    async def history(self, session_id: str) -> List[Tuple[int, str]]:
+        if session_id not in self._sessions:
+            return []
+        contents, roles = self._sessions[session_id]
+        return list(zip(roles, contents))
+    
+    async def count(self, session_id: str) -> int:
+        session = self._sessions.get(session_id)
+        return len(session[1]) if session else 0
+    
+    async def clear(self) -> None:
+        self._sessions.clear()
+
+class RedisBackend:
+    """Transcripts stored in Redis lists, so history survives restarts and is readable from any worker.
+    
+    Only the stored transcript is shared: each process still caches its own model
+    context (and summary), seeded from Redis the first time it sees a session.
+    """
+    
+    def __init__(self, url: str = REDIS_URL, max_history: int = MAX_HISTORY, ttl: int = SESSION_TTL):
+        import redis.asyncio
+        
+        self.client = redis.asyncio.Redis.from_url(url, decode_responses=True)
+        self.max_history = max_history
+        self.ttl = ttl
+    
+    def _key(self, session_id: str) -> str:
+        return f"echoeats:chat:{session_id}"
+    
+    async def append(self, session_id: str, role: int, content: str) -> None:
+        key = self._key(session_id)
+        async with self.client.pipeline() as pipe:
+            pipe.rpush(key, json.dumps([role, content]))
+            pipe.ltrim(key, -self.max_history, -1)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+    
+    async def messages(self, session_id: str, last: Optional[int] = None) -> List[BaseMessage]:
+        start = -last if last else 0
+        return [to_message(*json.loads(raw)) for raw in await self.client.lrange(self._key(session_id), start, -1)]
+    
+    async def history(self, session_id: str) -> List[Tuple[int, str]]:
+        return [tuple(json.loads(raw)) for raw in await self.client.lrange(self._key(session_id), 0, -1)]
+    
+    async def count(self, session_id: str) -> int:
+        return await self.client.llen(self._key(session_id))
+    
+    async def clear(self) -> None:
+        async for key in self.client.scan_iter("echoeats:chat:*"):
+            await self.client.delete(key)
+
+class SQLiteBackend:
+    """Transcripts persisted in an indexed SQLite table (WAL mode for files, or ":memory:")."""
+    
+    def __init__(self, path: str = SQLITE_PATH, max_history: int = MAX_HISTORY):
+        self.max_history = max_history
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages (session_id TEXT, ts INTEGER, role INTEGER, content TEXT)"
+        )
+        # Messages are ordered by rowid (insertion order); ts is informational only
+        self.conn.execute("DROP INDEX IF EXISTS idx_messages_session")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_rowid ON messages (session_id)")
+    
+    async def append(self, session_id: str, role: int, content: str) -> None:
+        self.conn.execute(
+            "INSERT INTO messages (session_id, ts, role, content) VALUES (?, ?, ?, ?)",
+            (session_id, time.time_ns(), role, content)
+        )
+        # Keep only the newest max_history messages per session, as the other backends do
+        self.conn.execute(
+            "DELETE FROM messages WHERE session_id = ? AND rowid NOT IN "
+            "(SELECT rowid FROM messages WHERE session_id = ? ORDER BY rowid DESC LIMIT ?)",
+            (session_id, session_id, self.max_history)
+        )
+    
+    def _rows(self, session_id: str, last: Optional[int] = None) -> List[Tuple[int, str]]:
+        # The newest max_history messages form the visible transcript, as with the other backends
+        rows = self.conn.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY rowid DESC LIMIT ?",
+            (session_id, min(last, self.max_history) if last is not None else self.max_history)
+        ).fetchall()
+        rows.reverse()
+        return rows
+    
+    async def messages(self, session_id: str, last: Optional[int] = None) -> List[BaseMessage]:
+        return [to_message(role, content) for role, content in self._rows(session_id, last)]
+    
+    async def history(self, session_id: str) -> List[Tuple[int, str]]:
+        return self._rows(session_id)
+    
+    async def count(self, session_id: str) -> int:
+        (count,) = self.conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return min(count, self.max_history)
+    
+    async def clear(self) -> None:
+        self.conn.execute("DELETE FROM messages")
+
+def create_memory_backend() -> MemoryBackend:
+    """Create the chat history backend selected by MEMORY_BACKEND."""
+    if MEMORY_BACKEND == "sqlite":
+        try:
+            backend = SQLiteBackend()
+            print(f"Using SQLite chat memory at {SQLITE_PATH}")
+            return backend
+        except Exception as e:
+            print(f"Failed to initialize SQLite memory, falling back to in-memory: {e}")
+    elif MEMORY_BACKEND == "redis":
+        try:
+            backend = RedisBackend()
+            print(f"Using Redis chat memory at {REDIS_URL}")
+            return backend
+        except Exception as e:
+            print(f"Failed to initialize Redis memory, falling back to in-memory: {e}")
+    return InMemoryBackend()
+
+class ArchivalMemory:
+    """Embedding index over turns that have left a session's context window."""
+    
+    def __init__(self, model_name: str = EMBEDDING_MODEL, max_sessions: int = MAX_SESSIONS):
+        import numpy as np
+        from sentence_transformers import SentenceTransformer
+        
+        self._np = np
+        self.model = SentenceTransformer(model_name)
+        self.max_sessions = max_sessions
+        # Per session: float16 unit vectors (one row per turn) and the turn texts
+        self._sessions: "OrderedDict[str, Tuple[any, List[str]]]" = OrderedDict()
+    
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+    
+    def add(self, session_id: str, texts: List[str]) -> None:
+        if not texts:
+            return
+        vectors = self.model.encode(texts, normalize_embeddings=True).astype(self._np.float16)
+        if session_id in self._sessions:
+            old_vectors, old_texts = self._sessions[session_id]
+            vectors = self._np.vstack([old_vectors, vectors])
+            texts = old_texts + texts
+        self._sessions[session_id] = (vectors, texts)
+        self._sessions.move_to_end(session_id)
+        if len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+    
+    def search(self, session_id: str, query: str, k: int = RECALL_K) -> List[str]:
+        if session_id not in self._sessions:
+            return []
+        self._sessions.move_to_end(session_id)
+        
+        vectors, texts = self._sessions[session_id]
+        query_vector = self.model.encode([query], normalize_embeddings=True)[0].astype(self._np.float16)
+        scores = vectors @ query_vector
+        if len(texts) > k:
+            top = self._np.argpartition(scores, -k)[-k:]
+        else:
+            top = range(len(texts))
+        # Keep recalled turns in conversation order
+        return [texts[i] for i in sorted(top)]
+    
+    def clear(self) -> None:
+        self._sessions.clear()
+
+def create_archive() -> Optional[ArchivalMemory]:
+    """Create the embedding archive if MEMORY_RETRIEVAL is enabled."""
+    if not MEMORY_RETRIEVAL:
+        return None
+    try:
+        archive = ArchivalMemory()
+        print(f"Using embedding recall with model: {EMBEDDING_MODEL}")
+        return archive
+    except Exception as e:
+        print(f"Failed to initialize embedding recall: {e}")
+        return None
+
+class SimpleMemory:
+    """Chat history storage with a cached, bounded model context per session."""
+    
+    def __init__(self, backend: Optional[MemoryBackend] = None):
+        self._backend = backend or create_memory_backend()
+        self._archive = create_archive()
+        # Context sent to the model: optional summary message + recent turns
+        self._prefix: "OrderedDict[str, List]" = OrderedDict()
+        self._count: Dict[str, int] = {}
+    
+    async def load_memory_variables(self, inputs: Dict[str, any]) -> Dict[str, any]:
+        session_id = inputs.get("session_id", "default")
+        messages = await self._backend.messages(session_id)
+        return {"messages": messages}
+    
+    async def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        """Get a session's transcript as role/content dicts without building message objects."""
+        return [{"role": ROLE_NAMES[role], "content": content} for role, content in await self._backend.history(session_id)]
+    
+    async def message_count(self, session_id: str) -> int:
+        """Get the number of stored messages for a session."""
+        return await self._backend.count(session_id)
+    
+    async def get_prefix(self, session_id: str) -> List:
+        """Get the cached model context (summary + recent turns) for a session."""
+        if session_id not in self._prefix:
+            # Seed from stored history, e.g. a session started on another worker
+            recent = await self._backend.messages(session_id, last=MAX_TURNS * 2)
+            self._prefix[session_id] = recent
+            self._count[session_id] = len(recent) // 2
+            self._evict()
+        self._prefix.move_to_end(session_id)
+        return self._prefix[session_id]
+    
+    def turn_count(self, session_id: str) -> int:
+        """Get the number of verbatim turns in the cached context."""
+        return self._count.get(session_id, 0)
+    
+    async def save_context(self, inputs: Dict[str, any], outputs: Dict[str, str]) -> None:
+        session_id = inputs.get("session_id", "default")
+        prefix = await self.get_prefix(session_id)
+        
+        # Add user message
+        if "message" in inputs:
+            await self._backend.append(session_id, USER, inputs["message"])
+            prefix.append(HumanMessage(content=inputs["message"]))
+        
+        # Add AI response
+        if "reply" in outputs:
+            await self._backend.append(session_id, ASSISTANT, outputs["reply"])
+            prefix.append(AIMessage(content=outputs["reply"]))
+            self._count[session_id] += 1
+    
+    async def compact(self, session_id: str, summary: str, keep_turns: int) -> None:
+        """Replace all but the last `keep_turns` turns of the context with a summary."""
+        recent = (await self.get_prefix(session_id))[-keep_turns * 2:] if keep_turns else []
+        self._prefix[session_id] = [SystemMessage(content=f"Summary so far: {summary}")] + recent
+        self._count[session_id] = keep_turns
+    
+    def archive(self, session_id: str, messages: List) -> None:
+        """Index turns leaving the context window so they can be recalled later."""
+        if self._archive is None:
+            return
+        turns = []
+        for msg in messages:
+            if msg.type == "human":
+                turns.append(f"Human: {msg.content}")
+            elif msg.type == "ai" and turns:
+                turns[-1] += f"\nAssistant: {msg.content}"
+        self._archive.add(session_id, turns)
+    
+    def can_recall(self, session_id: str) -> bool:
+        """Check whether a session has archived turns to recall from."""
+        return self._archive is not None and session_id in self._archive
+    
+    def recall(self, session_id: str, query: str) -> List[str]:
+        """Get the archived turns most similar to a query."""
+        if not self.can_recall(session_id):
+            return []
+        return self._archive.search(session_id, query)
+    
+    def _evict(self) -> None:
+        """Drop cached context for the least recently used sessions."""
+        while len(self._prefix) > MAX_SESSIONS:
+            session_id, _ = self._prefix.popitem(last=False)
+            self._count.pop(session_id, None)
+    
+    async def clear(self) -> None:
+        await self._backend.clear()
+        if self._archive is not None:
+            self._archive.clear()
+        self._prefix.clear()
+        self._count.clear()
@@ -1,14 +1,90 @@
-import json
+import asyncio
 import os
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Any
+import functools
+import re
+import time
+import shutil
+import orjson
+import simdjson
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, OrderedDict
+from itertools import islice
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Optional, Any, Set, Tuple, Iterable, Iterator
 from dataclasses import dataclass
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
+from rate_limit import throttle
 
 load_dotenv()
 
+# Order storage: a JSON document (default), an append-only log with one JSON order
+# per line (".jsonl"), or a directory ending in ".parquet" holding orders/ and
+# order_items/ Parquet datasets (requires pyarrow). New log and Parquet stores are
+# seeded from orders.json.
+ORDERS_DB_PATH = os.getenv("ORDERS_DB_PATH", "orders.json")
+
+# Newest orders kept in memory for a ".jsonl" store; older ones are read back
+# from the log on demand (0 keeps every order in memory)
+HOT_ORDERS_MAX = int(os.getenv("HOT_ORDERS_MAX", 200))
+
+# Maximum number of memoized query-generation results
+QUERY_CACHE_MAX = int(os.getenv("QUERY_CACHE_MAX", 1024))
+
+# Micro-batching of concurrent query-generation calls into one LLM request
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", 16))
+QUERY_BATCH_WINDOW = float(os.getenv("QUERY_BATCH_WINDOW_MS", 20)) / 1000
+
+# Search parameters the query LLM may emit, shared by the single and batched prompts
+SEARCH_PARAMETERS = """- date: specific date in YYYY-MM-DD format
+- day_of_week: "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"
+- food_item: name of food item (e.g., "pizza", "burger", "wings")
+- time_period: "latest", "last_week", "last_month"
+- limit: number of results to return (default: 1)"""
+
+# Markdown code fence the query LLM sometimes wraps its JSON answer in
+JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL)
+
+# Food keywords recognised in order searches, in lookup priority order
+FOODS = ("pizza", "burger", "pasta", "salad", "wings", "fish", "chicken", "nachos")
+FOOD_RE = re.compile("|".join(FOODS))
+
+# Query intents in priority order, recognised with a single regex scan
+INTENT_PRIORITY = ("dow", "week", "latest", "food")
+INTENT_RE = re.compile(
+    r"\b(?P<dow>monday|tuesday|wednesday|thursday|friday|saturday|sunday)(?=s?\b)"
+    r"|\b(?P<week>last week)\b"
+    r"|\b(?P<latest>latest|most recent|last order)\b"
+    rf"|\b(?P<food>{'|'.join(FOODS)})(?=s?\b)"
+)
+
+# Whole queries with a single constraint, answered without calling the query LLM
+FAST_QUERY_RE = re.compile(
+    r"(?:what was )?(?:my )?(?:the )?(?P<latest>latest|most recent|last) order"
+    r"|(?:what did i (?:order|have|get) )?(?:(?:my )?orders? )?(?:on |from )?(?:last )?"
+    r"(?P<dow>monday|tuesday|wednesday|thursday|friday|saturday|sunday)(?:'s)?(?: order)?"
+    r"|(?:what did i (?:order|have|get) )?(?:(?:my )?orders? )?(?:from |during )?(?P<week>last week)(?:'s orders?)?"
+    rf"|(?:my )?(?P<food>{'|'.join(FOODS)})s?(?: orders?)?"
+)
+
+def classify_intent(query: str) -> Optional[Tuple[str, str]]:
+    """Return the highest-priority (intent, matched text) found in a lowercased query."""
+    def rank(match: "re.Match[str]") -> Tuple[int, int]:
+        # Foods also rank among themselves by their FOODS order
+        food_rank = FOODS.index(match.group()) if match.lastgroup == "food" else 0
+        return INTENT_PRIORITY.index(match.lastgroup), food_rank
+    
+    best = min(INTENT_RE.finditer(query), key=rank, default=None)
+    return (best.lastgroup, best.group()) if best else None
+
+@functools.lru_cache(maxsize=8)
+def _last_week_range(today: date) -> Tuple[str, str]:
+    """ISO start and end dates (Monday to Sunday) of the week before ``today``."""
+    start = today - timedelta(days=today.weekday() + 7)
+    return start.isoformat(), (start + timedelta(days=6)).isoformat()
+
 @dataclass
 class OrderItem:
     name: str
@@ -27,90 +103,360 @@ class Order:
     restaurant: str
 
 class OrderDatabase:
-    """Local JSON database for food orders."""
+    """Local JSON (or Parquet) database for food orders."""
     
-    def __init__(self, db_path: str = "orders.json"):
+    # Shared SIMD JSON parser; its internal buffers are reused across loads
+    _parser = simdjson.Parser()
+    
+    _instance: Optional["OrderDatabase"] = None
+    
+    def __init__(self, db_path: str = ORDERS_DB_PATH):
         self.db_path = db_path
-        self.orders: List[Dict[str, Any]] = []
+        if self.is_parquet:
+            # Fail at startup rather than serving an empty database
+            try:
+                import pyarrow.parquet
+            except ImportError as e:
+                raise ImportError(f"ORDERS_DB_PATH={db_path} needs pyarrow (pip install pyarrow)") from e
+        # Evicted (cold) orders are None here and live only in the ".jsonl" log
+        self.orders: List[Optional[Dict[str, Any]]] = []
         self.load_orders()
     
+    @classmethod
+    def instance(cls) -> "OrderDatabase":
+        """Get the shared database, loading it on first use."""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+    
+    def _build_indexes(self) -> None:
+        """Index orders by user/day, user/item token and per-user date order."""
+        # Row numbers are kept in typed arrays rather than lists of int objects
+        self._by_dow: Dict[Tuple[str, str], array] = defaultdict(lambda: array('l'))
+        self._by_item_token: Dict[str, Dict[str, Set[int]]] = defaultdict(lambda: defaultdict(set))
+        # Per user, column-wise: order dates sorted ascending and the matching row numbers
+        self._user_dates: Dict[str, List[str]] = defaultdict(list)
+        self._user_rows: Dict[str, array] = defaultdict(lambda: array('l'))
+        # Per user: first order placed on the most recent date
+        self._latest_by_user: Dict[str, Dict[str, Any]] = {}
+        self._latest_by_dow: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Per row: lowercased item names, computed once at ingest
+        self._item_names: List[Tuple[str, ...]] = []
+        for row, order in enumerate(self.orders):
+            self._index_order(row, order)
+    
+    def _index_order(self, row: int, order: Dict[str, Any]) -> None:
+        """Add a single order to the indexes."""
+        user_id = order['user_id']
+        self._by_dow[(user_id, order['day_of_week'])].append(row)
+        names = tuple(item['name'].lower() for item in order['items'])
+        self._item_names.append(names)
+        for name in names:
+            for token in name.split():
+                self._by_item_token[user_id][token].add(row)
+        
+        # Insert after orders with the same date to keep insertion order for ties
+        dates = self._user_dates[user_id]
+        position = bisect_right(dates, order['date'])
+        dates.insert(position, order['date'])
+        self._user_rows[user_id].insert(position, row)
+        
+        # Only a strictly newer date replaces the latest, so ties keep the first order
+        for latest_index, key in ((self._latest_by_user, user_id),
+                                  (self._latest_by_dow, (user_id, order['day_of_week']))):
+            latest = latest_index.get(key)
+            if latest is None or order['date'] > latest['date']:
+                latest_index[key] = order
+    
+    @property
+    def is_parquet(self) -> bool:
+        return self.db_path.endswith(".parquet")
+    
+    @property
+    def is_jsonl(self) -> bool:
+        return self.db_path.endswith(".jsonl")
+    
     def load_orders(self) -> None:
-        """Load orders from JSON file."""
+        """Load orders from the JSON log, JSON file or Parquet datasets."""
+        # Byte offset of each order's line in the log, or -1 if it was never written
+        self._offsets = array('q')
+        self._hot_start = 0
         try:
-            if os.path.exists(self.db_path):
-                with open(self.db_path, 'r') as f:
-                    data = json.load(f)
-                    self.orders = data.get('orders', [])
+            old_path = f"{self.db_path}.old"
+            if self.is_parquet and not os.path.exists(self.db_path) and os.path.exists(old_path):
+                # A compaction stopped between moving the old store aside and the new one in
+                os.rename(old_path, self.db_path)
+            
+            if (self.is_parquet or self.is_jsonl) and not os.path.exists(self.db_path):
+                # Seed a new store from the JSON database
+                self.orders = self._read_json("orders.json")
+                if self.orders:
+                    self.save_orders()
+            elif self.is_parquet:
+                self.orders = self._read_parquet()
+            elif self.is_jsonl:
+                self.orders, self._offsets, torn = self._read_jsonl()
+                if torn:
+                    # Rewrite the log so later appends don't land on a partial line
+                    self.save_orders()
             else:
-                self.orders = []
+                self.orders = self._read_json(self.db_path)
         except Exception as e:
             print(f"Error loading orders: {e}")
             self.orders = []
+        self._build_indexes()
+        self._evict_cold()
+    
+    def _read_json(self, path: str) -> List[Dict[str, Any]]:
+        """Parse the orders array of a JSON database file."""
+        if not os.path.exists(path):
+            return []
+        document = self._parser.load(path)
+        orders = document.get('orders')
+        result = orders.as_list() if orders is not None else []
+        # Drop document proxies so the parser can be reused
+        del orders, document
+        return result
+    
+    def _read_jsonl(self) -> Tuple[List[Dict[str, Any]], array, bool]:
+        """Read one order per line from the log, skipping lines cut short by a crash."""
+        orders = []
+        offsets = array('q')
+        torn = False
+        position = 0
+        with open(self.db_path, 'rb') as f:
+            for line in f:
+                try:
+                    orders.append(orjson.loads(line))
+                    offsets.append(position)
+                except orjson.JSONDecodeError:
+                    torn = True
+                position += len(line)
+        if torn:
+            print(f"Skipped unreadable lines in {self.db_path}")
+        return orders, offsets, torn
+    
+    @staticmethod
+    def _parquet_schemas() -> Dict[str, Any]:
+        """Explicit schemas of the orders and order_items datasets.
+        
+        Fields outside a schema are kept as a JSON object in its "extra" column, so
+        no field is dropped however the rows vary.
+        """
+        import pyarrow as pa
+        
+        return {
+            "orders": pa.schema([
+                ("id", pa.string()), ("user_id", pa.string()), ("date", pa.string()),
+                ("day_of_week", pa.string()), ("total", pa.float64()), ("restaurant", pa.string()),
+                ("extra", pa.string()),
+            ]),
+            "order_items": pa.schema([
+                ("order_id", pa.string()), ("name", pa.string()), ("quantity", pa.int64()),
+                ("price", pa.float64()), ("category", pa.string()),
+                ("extra", pa.string()),
+            ]),
+        }
+    
+    @staticmethod
+    def _to_parquet_row(record: Dict[str, Any], columns: Set[str]) -> Dict[str, Any]:
+        """Split a record into schema columns and a JSON "extra" column for the rest."""
+        row = {key: value for key, value in record.items() if key in columns}
+        extra = {key: value for key, value in record.items() if key not in columns}
+        row['extra'] = orjson.dumps(extra).decode() if extra else None
+        return row
+    
+    @staticmethod
+    def _from_parquet_row(row: Dict[str, Any]) -> Dict[str, Any]:
+        """Merge a row's "extra" fields back into the record."""
+        extra = row.pop('extra', None)
+        if extra:
+            row.update(orjson.loads(extra))
+        return row
+    
+    def _read_parquet(self) -> List[Dict[str, Any]]:
+        """Read the orders and order_items datasets and nest items under their orders."""
+        import pyarrow.parquet as pq
+        
+        schemas = self._parquet_schemas()
+        orders_path = os.path.join(self.db_path, "orders")
+        items_path = os.path.join(self.db_path, "order_items")
+        if not os.path.exists(orders_path):
+            return []
+        
+        orders = [self._from_parquet_row(row)
+                  for row in pq.read_table(orders_path, schema=schemas["orders"]).to_pylist()]
+        items_by_order = defaultdict(list)
+        if os.path.exists(items_path):
+            for item in pq.read_table(items_path, schema=schemas["order_items"]).to_pylist():
+                items_by_order[item.pop('order_id')].append(self._from_parquet_row(item))
+        for order in orders:
+            order['items'] = items_by_order.get(order['id'], [])
+        return orders
+    
+    def _write_parquet(self, orders: List[Dict[str, Any]], root: Optional[str] = None) -> None:
+        """Write orders as a new row group file in each Parquet dataset."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        root = root or self.db_path
+        schemas = self._parquet_schemas()
+        order_columns = set(schemas["orders"].names) - {'extra'}
+        item_columns = set(schemas["order_items"].names) - {'extra', 'order_id'}
+        order_rows = [self._to_parquet_row({key: value for key, value in order.items() if key != 'items'}, order_columns)
+                      for order in orders]
+        item_rows = [{'order_id': order['id'], **self._to_parquet_row(item, item_columns)}
+                     for order in orders for item in order['items']]
+        # Zero-padded timestamps keep part files in insertion order
+        part = f"part-{time.time_ns():020d}.parquet"
+        for name, rows in (("orders", order_rows), ("order_items", item_rows)):
+            if rows:
+                os.makedirs(os.path.join(root, name), exist_ok=True)
+                table = pa.Table.from_pylist(rows, schema=schemas[name])
+                pq.write_table(table, os.path.join(root, name, part))
     
     def save_orders(self) -> None:
-        """Save orders to JSON file."""
+        """Save all orders to the JSON file, or compact the JSON log or Parquet datasets."""
         try:
+            if self.is_parquet:
+                # Write the compacted store beside the old one, then swap it in;
+                # load_orders restores the old store if this stops between the renames
+                tmp_path, old_path = f"{self.db_path}.tmp", f"{self.db_path}.old"
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                os.makedirs(tmp_path)
+                self._write_parquet(self.orders, tmp_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+                if os.path.exists(self.db_path):
+                    os.rename(self.db_path, old_path)
+                os.rename(tmp_path, self.db_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+                return
+            
+            if self.is_jsonl:
+                # Write a fresh log and swap it in atomically
+                tmp_path = f"{self.db_path}.tmp"
+                offsets = array('q')
+                with open(tmp_path, 'wb') as f:
+                    for order in self._iter_orders(range(len(self.orders))):
+                        offsets.append(f.tell())
+                        f.write(orjson.dumps(order) + b"\n")
+                os.replace(tmp_path, self.db_path)
+                self._offsets = offsets
+                return
+            
             data = {"orders": self.orders}
-            with open(self.db_path, 'w') as f:
-                json.dump(data, f, indent=2)
+            with open(self.db_path, 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
         except Exception as e:
             print(f"Error saving orders: {e}")
     
+    def _iter_orders(self, rows: Iterable[int]) -> Iterator[Dict[str, Any]]:
+        """Yield orders by row number, reading evicted ones back from the log."""
+        log = None
+        try:
+            for row in rows:
+                order = self.orders[row]
+                if order is None:
+                    if log is None:
+                        log = open(self.db_path, 'rb')
+                    log.seek(self._offsets[row])
+                    order = orjson.loads(log.readline())
+                yield order
+        finally:
+            if log is not None:
+                log.close()
+    
+    def _orders(self, rows: Iterable[int]) -> List[Dict[str, Any]]:
+        return list(self._iter_orders(rows))
+    
+    def _evict_cold(self) -> None:
+        """Drop logged orders older than the newest HOT_ORDERS_MAX from memory."""
+        if not (self.is_jsonl and HOT_ORDERS_MAX):
+            return
+        while len(self.orders) - self._hot_start > HOT_ORDERS_MAX:
+            # Orders whose append failed stay in memory
+            if self._offsets[self._hot_start] >= 0:
+                self.orders[self._hot_start] = None
+            self._hot_start += 1
+    
     def get_orders_by_date(self, date: str, user_id: str = "user_darshan") -> List[Dict[str, Any]]:
         """Get orders for a specific date."""
-        return [order for order in self.orders 
-                if order['date'] == date and order['user_id'] == user_id]
+        dates = self._user_dates.get(user_id, [])
+        rows = self._user_rows.get(user_id, ())
+        return self._orders(rows[bisect_left(dates, date):bisect_right(dates, date)])
     
     def get_orders_by_day_of_week(self, day_of_week: str, user_id: str = "user_darshan") -> List[Dict[str, Any]]:
         """Get orders for a specific day of the week."""
-        return [order for order in self.orders 
-                if order['day_of_week'] == day_of_week and order['user_id'] == user_id]
+        return self._orders(self._by_dow.get((user_id, day_of_week), ()))
     
     def get_orders_by_date_range(self, start_date: str, end_date: str, user_id: str = "user_darshan") -> List[Dict[str, Any]]:
         """Get orders within a date range."""
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+        # Validate once; ISO dates then compare correctly as strings
+        datetime.strptime(start_date, "%Y-%m-%d")
+        datetime.strptime(end_date, "%Y-%m-%d")
         
-        result = []
-        for order in self.orders:
-            if order['user_id'] == user_id:
-                order_date = datetime.strptime(order['date'], "%Y-%m-%d")
-                if start_dt <= order_date <= end_dt:
-                    result.append(order)
+        dates = self._user_dates.get(user_id, [])
+        rows = self._user_rows.get(user_id, ())
+        in_range = rows[bisect_left(dates, start_date):bisect_right(dates, end_date)]
         
-        return result
+        # Return in insertion order, as the database stores them
+        return self._orders(sorted(in_range))
     
     def get_latest_order(self, user_id: str = "user_darshan") -> Optional[Dict[str, Any]]:
         """Get the most recent order."""
-        user_orders = [order for order in self.orders if order['user_id'] == user_id]
-        if not user_orders:
-            return None
-        
-        # Sort by date (most recent first)
-        user_orders.sort(key=lambda x: x['date'], reverse=True)
-        return user_orders[0]
+        return self._latest_by_user.get(user_id)
+    
+    def get_latest_order_by_day_of_week(self, day_of_week: str, user_id: str = "user_darshan") -> Optional[Dict[str, Any]]:
+        """Get the most recent order placed on a specific day of the week."""
+        return self._latest_by_dow.get((user_id, day_of_week))
     
     def get_orders_by_item_name(self, item_name: str, user_id: str = "user_darshan") -> List[Dict[str, Any]]:
         """Get orders containing a specific item."""
-        result = []
-        for order in self.orders:
-            if order['user_id'] == user_id:
-                for item in order['items']:
-                    if item_name.lower() in item['name'].lower():
-                        result.append(order)
-                        break
-        return result
+        needle = item_name.lower()
+        words = needle.split()
+        tokens = self._by_item_token.get(user_id, {})
+        
+        # Candidate rows contain every word of the needle within some item-name token
+        candidates: Optional[Set[int]] = None
+        for word in words:
+            rows = tokens[word] if word in tokens else set()
+            rows = rows.union(*(token_rows for token, token_rows in tokens.items() if word in token and token != word))
+            candidates = rows if candidates is None else candidates & rows
+        
+        if candidates is None:
+            candidates = {row for token_rows in tokens.values() for row in token_rows}
+        if len(words) != 1 or needle != words[0]:
+            # Blank, multi-word and space-padded needles must still appear within a single item name
+            candidates = {row for row in candidates
+                          if any(needle in name for name in self._item_names[row])}
+        return self._orders(sorted(candidates))
     
     def add_order(self, order: Dict[str, Any]) -> None:
         """Add a new order to the database."""
         self.orders.append(order)
-        self.save_orders()
+        self._index_order(len(self.orders) - 1, order)
+        if self.is_parquet or self.is_jsonl:
+            # Append a row group or log line instead of rewriting the whole store
+            try:
+                if self.is_parquet:
+                    self._write_parquet([order])
+                else:
+                    self._offsets.append(-1)
+                    with open(self.db_path, 'ab') as f:
+                        offset = f.tell()
+                        f.write(orjson.dumps(order) + b"\n")
+                    self._offsets[-1] = offset
+                    self._evict_cold()
+            except Exception as e:
+                print(f"Error saving order: {e}")
+        else:
+            self.save_orders()
 
 class OrderSearchTool:
     """Tool for searching food orders that can be called by the LLM."""
     
-    def __init__(self):
-        self.db = OrderDatabase()
+    def __init__(self, db: Optional[OrderDatabase] = None):
+        self.db = db or OrderDatabase.instance()
     
     def search_orders(self, query: str, user_id: str = "user_darshan") -> Dict[str, Any]:
         """
@@ -126,33 +472,32 @@ class OrderSearchTool:
         query_lower = query.lower()
         
         # Parse different types of queries
-        if "last friday" in query_lower or "friday" in query_lower:
-            return self._search_by_day("Friday", user_id)
-        elif "last monday" in query_lower or "monday" in query_lower:
-            return self._search_by_day("Monday", user_id)
-        elif "last week" in query_lower or "week" in query_lower:
+        intent = classify_intent(query_lower)
+        if intent is None:
+            return self._search_general(query_lower, user_id)
+        
+        kind, text = intent
+        if kind == "dow":
+            return self._search_by_day(text.capitalize(), user_id)
+        elif kind == "week":
             return self._search_last_week(user_id)
-        elif "latest" in query_lower or "most recent" in query_lower:
+        elif kind == "latest":
             return self._search_latest(user_id)
-        elif any(food in query_lower for food in ["pizza", "burger", "pasta", "salad", "wings", "fish"]):
-            return self._search_by_food_item(query_lower, user_id)
         else:
-            return self._search_general(query_lower, user_id)
+            return self._search_by_food_item(query_lower, user_id)
     
     def _search_by_day(self, day: str, user_id: str) -> Dict[str, Any]:
         """Search orders by day of week."""
-        orders = self.db.get_orders_by_day_of_week(day, user_id)
+        # Get the most recent order for that day
+        latest_order = self.db.get_latest_order_by_day_of_week(day, user_id)
         
-        if not orders:
+        if not latest_order:
             return {
                 "found": False,
                 "message": f"No orders found for {day}",
                 "orders": []
             }
         
-        # Get the most recent order for that day
-        latest_order = max(orders, key=lambda x: x['date'])
-        
         return {
             "found": True,
             "message": f"Found your {day} order from {latest_order['date']}",
@@ -162,15 +507,8 @@ class OrderSearchTool:
     
     def _search_last_week(self, user_id: str) -> Dict[str, Any]:
         """Search orders from last week."""
-        today = datetime.now()
-        last_week_start = today - timedelta(days=today.weekday() + 7)
-        last_week_end = last_week_start + timedelta(days=6)
-        
-        orders = self.db.get_orders_by_date_range(
-            last_week_start.strftime("%Y-%m-%d"),
-            last_week_end.strftime("%Y-%m-%d"),
-            user_id
-        )
+        last_week_start, last_week_end = _last_week_range(date.today())
+        orders = self.db.get_orders_by_date_range(last_week_start, last_week_end, user_id)
         
         if not orders:
             return {
@@ -206,10 +544,11 @@ class OrderSearchTool:
     
     def _search_by_food_item(self, query: str, user_id: str) -> Dict[str, Any]:
         """Search orders by food item."""
-        food_keywords = ["pizza", "burger", "pasta", "salad", "wings", "fish", "chicken", "nachos"]
+        # Scan the query once, then try the matches in keyword priority order
+        matched = set(FOOD_RE.findall(query))
         
-        for keyword in food_keywords:
-            if keyword in query:
+        for keyword in FOODS:
+            if keyword in matched:
                 orders = self.db.get_orders_by_item_name(keyword, user_id)
                 
                 if orders:
@@ -248,16 +587,22 @@ class OrderSearchTool:
         return response.strip()
 
 # Create a global instance
-order_search_tool = OrderSearchTool()
+order_search_tool = OrderSearchTool(OrderDatabase.instance())
 
 class IntelligentOrderSearch:
     """Intelligent order search using LLM to generate queries."""
     
-    def __init__(self):
-        self.db = OrderDatabase()
-        self.query_llm = None
-        
-        # Initialize query generation LLM
+    def __init__(self, db: Optional[OrderDatabase] = None):
+        self.db = db or OrderDatabase.instance()
+        self._query_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        # In-flight batch requests are referenced here until they finish
+        self._dispatches: Set[asyncio.Task] = set()
+    
+    @functools.cached_property
+    def query_llm(self) -> Optional[ChatOpenAI]:
+        """Query generation LLM, created on first use rather than at import."""
         api_key = os.getenv("NIM_API_KEY")
         api_base = os.getenv("NIM_API_BASE")
         model_name = os.getenv("MODEL_NAME")
@@ -265,33 +610,100 @@ class IntelligentOrderSearch:
         if api_key and api_base and model_name:
             try:
                 # Use the same NVIDIA Nemotron model as the main LLM
-                self.query_llm = ChatOpenAI(
+                query_llm = ChatOpenAI(
                     model=model_name,
                     base_url=api_base,
                     api_key=api_key,
                     temperature=0.1  # Low temperature for consistent query generation
                 )
                 print(f"Successfully initialized query generation LLM with NVIDIA Nemotron: {model_name}")
+                return query_llm
             except Exception as e:
                 print(f"Failed to initialize query LLM: {e}")
-                self.query_llm = None
+        return None
     
     def generate_search_query(self, user_query: str, user_id: str = "user_darshan") -> Dict[str, Any]:
+        """Generate a structured search query, from the fast path or cache when possible."""
+        cache_key, query_params = self._lookup_query(user_query, user_id)
+        if query_params is None:
+            query_params = self._generate_with_llm(user_query, user_id)
+            self._cache_query(cache_key, query_params)
+        return query_params
+    
+    async def agenerate_search_query(self, user_query: str, user_id: str = "user_darshan") -> Dict[str, Any]:
+        """Async variant that coalesces concurrent LLM calls into batched requests."""
+        cache_key, query_params = self._lookup_query(user_query, user_id)
+        if query_params is None:
+            if not self.query_llm:
+                raise Exception("Query LLM not initialized. Cannot generate search query.")
+            
+            self._start_batch_worker()
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((user_query, user_id, future))
+            query_params = await future
+            self._cache_query(cache_key, query_params)
+        return query_params
+    
+    def _lookup_query(self, user_query: str, user_id: str) -> Tuple[Tuple[str, str], Optional[Dict[str, Any]]]:
+        """Return the cache key and any fast-path or cached search parameters."""
+        normalized = user_query.lower().strip().rstrip("?.!")
+        cache_key = (normalized, user_id)
+        fast = self._fast_path_query(normalized)
+        if fast is not None:
+            return cache_key, {"user_id": user_id, **fast}
+        
+        if cache_key in self._query_cache:
+            self._query_cache.move_to_end(cache_key)
+            return cache_key, dict(self._query_cache[cache_key])
+        return cache_key, None
+    
+    def _cache_query(self, cache_key: Tuple[str, str], query_params: Dict[str, Any]) -> None:
+        """Remember LLM-generated search parameters, evicting the least recently used."""
+        self._query_cache[cache_key] = dict(query_params)
+        if len(self._query_cache) > QUERY_CACHE_MAX:
+            self._query_cache.popitem(last=False)
+    
+    @staticmethod
+    def _fast_path_query(normalized: str) -> Optional[Dict[str, Any]]:
+        """Map common single-constraint phrasings straight to search parameters."""
+        match = FAST_QUERY_RE.fullmatch(normalized)
+        if match is None:
+            return None
+        
+        kind, text = match.lastgroup, match.group(match.lastgroup)
+        if kind == "dow":
+            return {"day_of_week": text.capitalize(), "limit": 1}
+        elif kind == "week":
+            return {"time_period": "last_week", "limit": 10}
+        elif kind == "latest":
+            return {"time_period": "latest", "limit": 1}
+        else:
+            return {"food_item": text, "limit": 5}
+    
+    def _generate_with_llm(self, user_query: str, user_id: str) -> Dict[str, Any]:
         """Use LLM to generate a structured search query from natural language."""
         
         if not self.query_llm:
             raise Exception("Query LLM not initialized. Cannot generate search query.")
         
-        prompt = f"""
+        try:
+            response = self.query_llm.invoke(self._query_prompt(user_query, user_id))
+            query_params = self._parse_json(response.content)
+            # Never trust the user the LLM echoes back; always search the caller's orders
+            return {**query_params, "user_id": user_id}
+        except Exception as e:
+            print(f"Error generating query: {e}")
+            raise Exception(f"Failed to generate search query: {e}")
+    
+    @staticmethod
+    def _query_prompt(user_query: str, user_id: str) -> str:
+        """Prompt asking the LLM for the search parameters of a single query."""
+        return f"""
 You are a query generator for a food order database. Convert the user's natural language query into a structured search query.
 
 Available search parameters:
 - user_id: "{user_id}" (always include this)
-- date: specific date in YYYY-MM-DD format
-- day_of_week: "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"
-- food_item: name of food item (e.g., "pizza", "burger", "wings")
-- time_period: "latest", "last_week", "last_month"
-- limit: number of results to return (default: 1)
+{SEARCH_PARAMETERS}
 
 User query: "{user_query}"
 
@@ -303,15 +715,97 @@ For "pizza orders": {{"user_id": "{user_id}", "food_item": "pizza", "limit": 5}}
 For "orders from last week": {{"user_id": "{user_id}", "time_period": "last_week", "limit": 10}}
 
 JSON response:"""
+    
+    @staticmethod
+    def _batch_prompt(queries: List[Tuple[str, str]]) -> str:
+        """Prompt asking the LLM for the search parameters of several queries at once."""
+        numbered = "\n".join(f'{i}. (user_id "{user_id}") "{user_query}"'
+                             for i, (user_query, user_id) in enumerate(queries, 1))
+        return f"""
+You are a query generator for a food order database. Convert each of the following {len(queries)} natural language queries into a structured search query.
 
-        try:
-            response = self.query_llm.invoke(prompt)
-            query_params = json.loads(response.content.strip())
-            return query_params
-        except Exception as e:
-            print(f"Error generating query: {e}")
-            raise Exception(f"Failed to generate search query: {e}")
+Available search parameters:
+- user_id: the user_id given with the query (always include this)
+{SEARCH_PARAMETERS}
+
+User queries:
+{numbered}
+
+Respond with ONLY a JSON object keyed by query number, each value containing that query's search parameters. Example:
+
+{{"1": {{"user_id": "user_darshan", "day_of_week": "Friday", "limit": 1}}, "2": {{"user_id": "user_darshan", "food_item": "pizza", "limit": 5}}}}
+
+JSON response:"""
+    
+    @staticmethod
+    def _parse_json(content: str) -> Any:
+        """Decode the LLM's JSON answer, unwrapping a code fence if present."""
+        # orjson tolerates surrounding whitespace, so only fences need stripping
+        fenced = JSON_FENCE_RE.match(content)
+        return orjson.loads(fenced.group(1) if fenced else content)
+    
+    def _start_batch_worker(self) -> None:
+        """Start the batch worker on the running event loop if needed."""
+        if self._batch_task is None:
+            self._queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._batch_worker())
+    
+    async def _batch_worker(self) -> None:
+        """Coalesce queries arriving within QUERY_BATCH_WINDOW into one LLM request."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + QUERY_BATCH_WINDOW
+            while len(batch) < QUERY_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Dispatch without blocking collection of the next batch
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+    
+    async def _dispatch(self, batch: List) -> None:
+        """Generate search parameters for a batch and resolve each caller's future."""
+        queries = [(user_query, user_id) for user_query, user_id, _ in batch]
+        results: List[Any] = [None] * len(batch)
+        if len(batch) > 1:
+            try:
+                prompt = self._batch_prompt(queries)
+                await throttle(prompt)
+                response = await self.query_llm.ainvoke(prompt)
+                by_number = self._parse_json(response.content)
+                results = [by_number.get(str(i)) for i in range(1, len(batch) + 1)]
+            except Exception as e:
+                print(f"Error generating batched queries: {e}")
+        
+        # Entries the batch reply left out or mangled (or a lone query) get their own prompt
+        retry = [i for i, result in enumerate(results) if not isinstance(result, dict)]
+        singles = await asyncio.gather(*[self._agenerate_with_llm(*queries[i]) for i in retry], return_exceptions=True)
+        for i, result in zip(retry, singles):
+            results[i] = result
+        
+        for (_, user_id, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, dict):
+                # Never trust the user the LLM echoes back; always search the caller's orders
+                future.set_result({**result, "user_id": user_id})
+            else:
+                print(f"Error generating query: {result}")
+                future.set_exception(Exception(f"Failed to generate search query: {result}"))
     
+    async def _agenerate_with_llm(self, user_query: str, user_id: str) -> Any:
+        """Ask the LLM for a single query's search parameters within the shared rate limits."""
+        prompt = self._query_prompt(user_query, user_id)
+        await throttle(prompt)
+        response = await self.query_llm.ainvoke(prompt)
+        return self._parse_json(response.content)
     
     def execute_search(self, query_params: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Execute the search query against the database."""
@@ -320,10 +814,16 @@ JSON response:"""
         
         results = []
         
-        # Search by day of week
+        # Search by day of week, most recent first (e.g. "last Friday")
         if "day_of_week" in query_params:
-            orders = self.db.get_orders_by_day_of_week(query_params["day_of_week"], user_id)
-            results.extend(orders)
+            day_of_week = query_params["day_of_week"]
+            if limit <= 1:
+                latest_order = self.db.get_latest_order_by_day_of_week(day_of_week, user_id)
+                if latest_order:
+                    results.append(latest_order)
+            else:
+                orders = self.db.get_orders_by_day_of_week(day_of_week, user_id)
+                results.extend(sorted(orders, key=lambda order: order['date'], reverse=True))
         
         # Search by food item
         elif "food_item" in query_params:
@@ -338,14 +838,8 @@ JSON response:"""
                 if latest_order:
                     results.append(latest_order)
             elif time_period == "last_week":
-                today = datetime.now()
-                last_week_start = today - timedelta(days=today.weekday() + 7)
-                last_week_end = last_week_start + timedelta(days=6)
-                orders = self.db.get_orders_by_date_range(
-                    last_week_start.strftime("%Y-%m-%d"),
-                    last_week_end.strftime("%Y-%m-%d"),
-                    user_id
-                )
+                last_week_start, last_week_end = _last_week_range(date.today())
+                orders = self.db.get_orders_by_date_range(last_week_start, last_week_end, user_id)
                 results.extend(orders)
         
         # Search by specific date
@@ -359,17 +853,11 @@ JSON response:"""
             if latest_order:
                 results.append(latest_order)
         
-        # Remove duplicates and limit results
-        seen_ids = set()
-        unique_results = []
-        for order in results:
-            if order['id'] not in seen_ids:
-                seen_ids.add(order['id'])
-                unique_results.append(order)
-                if len(unique_results) >= limit:
-                    break
-        
-        return unique_results
+        # Remove duplicates (first occurrence wins) and limit results; at least one is kept
+        seen_ids: Dict[str, None] = {}
+        unique_results = (order for order in results
+                          if order['id'] not in seen_ids and not seen_ids.setdefault(order['id']))
+        return list(islice(unique_results, max(limit, 1)))
     
     def search_orders(self, user_query: str, user_id: str = "user_darshan") -> str:
         """Main search function that combines query generation and execution."""
@@ -377,9 +865,15 @@ JSON response:"""
         query_params = self.generate_search_query(user_query, user_id)
         
         # Execute the search
-        results = self.execute_search(query_params)
-        
-        # Format results
+        return self._format_results(self.execute_search(query_params))
+    
+    async def asearch_orders(self, user_query: str, user_id: str = "user_darshan") -> str:
+        """Async search whose query generation is batched with concurrent callers."""
+        query_params = await self.agenerate_search_query(user_query, user_id)
+        return self._format_results(self.execute_search(query_params))
+    
+    def _format_results(self, results: List[Dict[str, Any]]) -> str:
+        """Format search results for display."""
         if not results:
             return "No orders found matching your criteria."
         
@@ -406,7 +900,7 @@ JSON response:"""
         return response.strip()
 
 # Create global instance
-intelligent_search = IntelligentOrderSearch()
+intelligent_search = IntelligentOrderSearch(OrderDatabase.instance())
 
 # Single LangChain Tool
 @tool
@@ -430,5 +924,11 @@ def search_order_history(query: str, user_id: str = "user_darshan") -> str:
     """
     return intelligent_search.search_orders(query, user_id)
 
+async def _asearch_order_history(query: str, user_id: str = "user_darshan") -> str:
+    return await intelligent_search.asearch_orders(query, user_id)
+
+# Async callers (tool.ainvoke) go through the batched query generator
+search_order_history.coroutine = _asearch_order_history
+
 # List of available tools (just one!)
 ORDER_TOOLS = [search_order_history]
@@ -0,0 +1,24 @@
+import os
+from typing import List, Union
+from aiolimiter import AsyncLimiter
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Client-side throttling kept just under the endpoint's published limits
+NIM_RPM = int(os.getenv("NIM_RPM", 500))
+NIM_TPM = int(os.getenv("NIM_TPM", 200_000))
+
+# Shared by every model on the endpoint (chat, summaries and order-query generation)
+rpm = AsyncLimiter(NIM_RPM, 60)
+tpm = AsyncLimiter(NIM_TPM, 60)
+
+async def throttle(prompt: Union[str, List]) -> None:
+    """Wait until a request and its estimated tokens fit the rate limits."""
+    if isinstance(prompt, str):
+        tokens = len(prompt) // 4
+    else:
+        tokens = sum(len(str(msg.content)) for msg in prompt) // 4
+    await rpm.acquire()
+    await tpm.acquire(min(max(tokens, 1), NIM_TPM))
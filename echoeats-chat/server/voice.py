@@ -1,21 +1,63 @@
 import os
 import io
-from typing import Optional
+import re
+import asyncio
+import hashlib
+import httpx
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
 from dotenv import load_dotenv
 from elevenlabs.client import ElevenLabs
 import base64
 
 load_dotenv()
 
+TTS_MODEL_ID = "eleven_multilingual_v2"
+TTS_OUTPUT_FORMAT = "mp3_44100_128"
+
+# Seconds before an ElevenLabs TTS/STT request is abandoned (the SDK's own default)
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", 240))
+
+# Maximum concurrent ElevenLabs synthesis requests, kept under the account's concurrency limit
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 4))
+
+# Maximum number of synthesized phrases kept for repeated replies
+TTS_CACHE_MAX = int(os.getenv("TTS_CACHE_MAX", 256))
+
+# Sentence boundary: terminal punctuation followed by whitespace
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+async def split_sentences(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Regroup streamed text chunks into complete sentences."""
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        *sentences, buffer = SENTENCE_END.split(buffer)
+        for sentence in sentences:
+            if sentence.strip():
+                yield sentence
+    if buffer.strip():
+        yield buffer
+
 class VoiceService:
     def __init__(self):
         self.api_key = os.getenv("ELEVENLABS_API_KEY")
         self.voice_id = os.getenv("ELEVENLABS_VOICE_ID", "JBFqnCBsd6RMkjVDRZzb")  # Default voice from quickstart
         self.client = None
+        self._http: Optional[httpx.Client] = None
+        self._audio_cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._tts_slots = asyncio.Semaphore(TTS_CONCURRENCY)
         
         if self.api_key:
             try:
-                self.client = ElevenLabs(api_key=self.api_key)
+                # One long-lived HTTP/2 pool so TTS/STT calls skip repeated TLS handshakes
+                self._http = httpx.Client(
+                    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300.0),
+                    http2=True,
+                    # The SDK takes its request timeout from this client; httpx's 5 s default is too short
+                    timeout=TTS_TIMEOUT
+                )
+                self.client = ElevenLabs(api_key=self.api_key, httpx_client=self._http)
                 print(f"Successfully initialized ElevenLabs with voice: {self.voice_id}")
             except Exception as e:
                 print(f"Failed to initialize ElevenLabs: {e}")
@@ -23,30 +65,110 @@ class VoiceService:
         else:
             print("ElevenLabs API key not found")
 
-    async def text_to_speech(self, text: str) -> Optional[str]:
-        """Convert text to speech and return base64 encoded audio"""
+    def _cache_key(self, text: str) -> str:
+        """Content address for synthesized audio"""
+        return hashlib.sha256(f"{self.voice_id}|{TTS_MODEL_ID}|{text}".encode()).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[bytes]:
+        audio = self._audio_cache.get(key)
+        if audio is not None:
+            self._audio_cache.move_to_end(key)
+        return audio
+
+    def _cache_put(self, key: str, audio: bytes) -> None:
+        self._audio_cache[key] = audio
+        if len(self._audio_cache) > TTS_CACHE_MAX:
+            self._audio_cache.popitem(last=False)
+
+    async def synthesize(self, text: str) -> Optional[bytes]:
+        """Convert text to speech and return raw MP3 audio"""
         if not self.client:
             return None
         
+        cache_key = self._cache_key(text)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             # Generate speech using the correct API method from the quickstart guide
-            audio = self.client.text_to_speech.convert(
-                text=text,
-                voice_id=self.voice_id,
-                model_id="eleven_multilingual_v2",
-                output_format="mp3_44100_128"
-            )
-            
-            # Convert to base64 for JSON response
-            audio_bytes = b"".join(audio)
-            audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
+            # Run the blocking SDK call off the event loop so synthesis can overlap other work
+            def convert() -> bytes:
+                audio = self.client.text_to_speech.convert(
+                    text=text,
+                    voice_id=self.voice_id,
+                    model_id=TTS_MODEL_ID,
+                    output_format=TTS_OUTPUT_FORMAT
+                )
+                return b"".join(audio)
             
-            return audio_base64
+            async with self._tts_slots:
+                audio_bytes = await asyncio.to_thread(convert)
+            self._cache_put(cache_key, audio_bytes)
+            return audio_bytes
             
         except Exception as e:
             print(f"Error generating speech: {e}")
             return None
 
+    async def text_to_speech_stream(self, text: str) -> AsyncIterator[bytes]:
+        """Convert text to speech, yielding MP3 chunks as the API produces them"""
+        if not self.client:
+            return
+        
+        cache_key = self._cache_key(text)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        chunks = None
+        try:
+            # Hold a synthesis slot for the whole stream, like synthesize()
+            async with self._tts_slots:
+                audio = await asyncio.to_thread(
+                    self.client.text_to_speech.convert,
+                    text=text,
+                    voice_id=self.voice_id,
+                    model_id=TTS_MODEL_ID,
+                    output_format=TTS_OUTPUT_FORMAT
+                )
+                
+                # Pull each chunk from the blocking SDK generator off the event loop
+                chunks = iter(audio)
+                parts = []
+                while True:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        parts.append(chunk)
+                        yield chunk
+            
+            # Only complete, non-empty audio is cached
+            if parts:
+                self._cache_put(cache_key, b"".join(parts))
+            
+        except Exception as e:
+            print(f"Error streaming speech: {e}")
+        finally:
+            # Release the upstream response if the client stopped reading early
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    print(f"Error closing speech stream: {e}")
+
+    async def text_to_speech(self, text: str) -> Optional[str]:
+        """Convert text to speech and return base64 encoded audio"""
+        audio_bytes = await self.synthesize(text)
+        if audio_bytes is None:
+            return None
+        
+        # Convert to base64 for JSON response
+        return base64.b64encode(audio_bytes).decode('utf-8')
+
     async def speech_to_text(self, audio_data: bytes) -> Optional[str]:
         """Convert speech to text using ElevenLabs STT API"""
         if not self.client:
@@ -54,8 +176,9 @@ class VoiceService:
             return None
         
         try:
-            # Use ElevenLabs Speech-to-Text API with correct parameters
-            response = self.client.speech_to_text.convert(
+            # Use ElevenLabs Speech-to-Text API with correct parameters, off the event loop
+            response = await asyncio.to_thread(
+                self.client.speech_to_text.convert,
                 file=audio_data,
                 model_id="scribe_v1"  # ElevenLabs STT model
             )
@@ -73,4 +196,9 @@ class VoiceService:
             print(f"ElevenLabs STT error: {e}")
             return None
 
+    def close(self) -> None:
+        """Close the shared HTTP connection pool."""
+        if self._http is not None:
+            self._http.close()
+
 voice_service = VoiceService()